@@ -60,6 +60,9 @@ db_sql = sql = """
         create index if not exists text_idx
             on messages_utc using gin (text_index_col);
         
+        -- Larger sample of lexemes so the planner can estimate how selective a full-text query is
+        alter table messages_utc alter column text_index_col set statistics 1000;
+        
         create index if not exists messages_utc_date_index
             on messages_utc (date);
         
@@ -68,6 +71,15 @@ db_sql = sql = """
         
         create index if not exists messages_utc_type_index
             on messages_utc (type);
+        
+        create index if not exists messages_utc_message_id_index
+            on messages_utc (message_id);
+        
+        create index if not exists messages_utc_type_from_user_date_index
+            on messages_utc (type, from_user, date);
+        
+        create index if not exists messages_utc_date_brin_index
+            on messages_utc using brin (date);
             
         create table if not exists user_events
         (
@@ -94,8 +106,35 @@ db_sql = sql = """
         create index if not exists user_names_user_id_date_index
             on user_names (user_id, date);
         
+        -- Matches the latest-name window in StatsRunner.get_db_users
+        create index if not exists user_names_user_id_date_desc_index
+            on user_names (user_id, date desc);
+        
+        -- Pre-aggregated message counts. Bucket columns are named date so the same filters apply,
+        -- and cnt is an integer so sum(cnt) is a bigint like count(*).
+        create materialized view if not exists messages_hourly as
+            select from_user, date_trunc('hour', date) as date, count(*)::integer as cnt
+            from messages_utc
+            group by 1, 2;
+        
+        create unique index if not exists messages_hourly_from_user_date_index
+            on messages_hourly (from_user, date);
+        
+        create materialized view if not exists messages_type_daily as
+            select type, from_user, date_trunc('day', date) as date, count(*)::integer as cnt
+            from messages_utc
+            group by 1, 2, 3;
+        
+        create unique index if not exists messages_type_daily_type_from_user_date_index
+            on messages_type_daily (type, from_user, date);
+        
         """
 
 
 def init_dbs(con: Connection):
     con.execute(text(db_sql))
+
+
+def refresh_views(con: Connection):
+    con.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY messages_hourly;"))
+    con.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY messages_type_daily;"))
@@ -76,7 +76,9 @@ class JSONStore(object):
 
 class PostgresStore(object):
     def __init__(self, connection_url: str):
-        self.engine = create_engine(connection_url, echo=False, isolation_level="AUTOCOMMIT")
+        self.engine = create_engine(connection_url, echo=False, isolation_level="AUTOCOMMIT",
+                                    pool_size=8, max_overflow=4, pool_pre_ping=True, pool_recycle=3600,
+                                    pool_use_lifo=True)
         if not database_exists(self.engine.url):
             create_database(connection_url, template='template1')
 
@@ -19,6 +19,7 @@
 # You should have received a copy of the GNU Public License
 # along with this program. If not, see [http://www.gnu.org/licenses/].
 
+import asyncio
 import logging
 import json
 import argparse
@@ -35,7 +36,7 @@ import appdirs
 
 from .parse import parse_message
 from .log_storage import JSONStore, PostgresStore
-from .stats import StatsRunner, get_parser, HelpException
+from .stats import StatsRunner, HelpException
 
 warnings.filterwarnings("ignore")
 
@@ -115,21 +116,31 @@ async def update_usernames(context: ContextTypes.DEFAULT_TYPE):  # context.job.c
     if stats.users_lock.acquire(timeout=10):
         stats.users = stats.get_db_users()
         stats.users_lock.release()
+        stats.stats_cache.clear()  # Cached output may contain old names
     else:
         logger.warning("Couldn't acquire username lock.")
         return
     logger.info("Usernames updated")
 
 
+async def refresh_stats_views(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(stats.refresh_views)  # Full view refresh, keep handling updates meanwhile
+    logger.debug("Stats views refreshed")
+
+
+def run_stats(func, args: dict):
+    with stats.connect():  # Reuse one connection for every query in this command
+        return func(**args)
+
+
 async def print_stats(update: Update, context: CallbackContext):
     if update.effective_user.id not in stats.users:
         return
 
-    stats_parser = get_parser(stats)
     image = None
 
     try:
-        ns = stats_parser.parse_args(shlex.split(" ".join(context.args)))
+        ns = stats.parser.parse_args(shlex.split(" ".join(context.args)))
     except HelpException as e:
         text = e.msg
         await send_help(text, context, update)
@@ -161,7 +172,8 @@ async def print_stats(update: Update, context: CallbackContext):
             pass
 
         try:
-            text, image = func(**args)
+            # Queries and plotting block, so run them in a worker thread to keep handling other updates
+            text, image = await asyncio.to_thread(run_stats, func, args)
         except HelpException as e:
             text = e.msg
             await send_help(text, context, update)
@@ -237,6 +249,7 @@ if __name__ == '__main__':
 
     job_queue = application.job_queue
     update_users_job = job_queue.run_repeating(update_usernames, interval=3600, first=5, chat_id=args.chat_id)
+    refresh_views_job = job_queue.run_repeating(refresh_stats_views, interval=300, first=300)
     test_privacy_job = job_queue.run_once(test_can_read_all_group_messages, 0)
 
     application.run_polling()
@@ -20,25 +20,33 @@
 # along with this program. If not, see [http://www.gnu.org/licenses/].
 
 import logging
-from typing import Dict, List, Tuple, Text, NoReturn, Union
+from typing import Dict, List, Tuple, Text, NoReturn, Union, Iterator, NamedTuple, Any
 from threading import Lock
 from io import BytesIO
 import argparse
 import inspect
 import re
-from datetime import timedelta, datetime
+import functools
+import random
+import queue
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
 
 import pandas as pd
 import seaborn as sns
 import numpy as np
+import matplotlib
 from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.dates import date2num
-from sqlalchemy.engine import Engine
-from sqlalchemy import select, func, text
+from sqlalchemy.engine import Engine, Connection
+from sqlalchemy import select, func, text, bindparam
 from sqlalchemy.dialects import postgresql
+from PIL import Image
 
-from .utils import escape_markdown, TsStat, random_quote
-from .db import messages
+from .utils import escape_markdown, TsStat, TTLCache, SingleFlight
+from .db import messages, refresh_views
 from . import __version__
 
 sns.set_context('paper')
@@ -48,15 +56,262 @@ sns.set_palette("Set2")
 logging.getLogger('matplotlib').setLevel(logging.WARNING)  # Mute matplotlib debug messages
 logger = logging.getLogger()
 
+param_match = re.compile(r"^:param (\w+): (.*)")
+non_ascii_match = re.compile(r'[^\x00-\x7F]')
+non_ascii_at_match = re.compile(r'[^\x00-\x7F]|[@]')
+
+# Constant statements with optional filters, so the server sees the same SQL for every argument combination.
+# Unused filters are passed as NULL.
+optional_filters = """
+                   (CAST(:start_dt AS timestamptz) IS NULL OR date >= :start_dt)
+                   AND (CAST(:end_dt AS timestamptz) IS NULL OR date < :end_dt)
+                   """
+
+# Group and user counts in a single scan, percentages from window sums over the groups
+type_stats_sql = """
+                 SELECT type, {count} as count,
+                        (100.0 * {count} / sum({count}) OVER ())::float as percent,
+                        coalesce({count} FILTER (WHERE from_user = :user), 0) as user_count,
+                        (100.0 * coalesce({count} FILTER (WHERE from_user = :user), 0)
+                         / nullif(sum(coalesce({count} FILTER (WHERE from_user = :user), 0)) OVER (), 0))::float
+                            as user_percent
+                 FROM {source}
+                 WHERE type NOT IN :excluded_types
+                       AND {filters}
+                 GROUP BY type
+                 ORDER BY count DESC, type;
+                 """
+type_stats_queries = {source: text(type_stats_sql.format(source=source, count=count, filters=optional_filters))
+                      .bindparams(bindparam('excluded_types', expanding=True))
+                      for source, count in (('messages_utc', 'count(*)'), ('messages_type_daily', 'sum(cnt)'))}
+
+random_message_filters = f"""
+                         type = 'text'
+                         AND (CAST(:lquery AS text) IS NULL OR text_index_col @@ to_tsquery(:lquery))
+                         AND (CAST(:user AS bigint) IS NULL OR from_user = :user)
+                         AND {optional_filters}
+                         """
+# Skip a random number of matching rows rather than sorting every row by random()
+random_message_query = text(f"""
+                            SELECT date, from_user, text
+                            FROM messages_utc
+                            WHERE {random_message_filters}
+                            OFFSET floor(random() * (SELECT count(*)
+                                                     FROM messages_utc
+                                                     WHERE {random_message_filters}))
+                            LIMIT 1;
+                            """)
+
+random_message_id_query = text("""
+                               SELECT date, from_user, text
+                               FROM messages_utc
+                               WHERE message_id >= :message_id AND type = 'text'
+                               ORDER BY message_id
+                               LIMIT 1;
+                               """)
+
+# Rows written to messages_utc so far, used to skip view refreshes when nothing changed
+messages_changes_query = text("""
+                             SELECT n_tup_ins + n_tup_upd + n_tup_del
+                             FROM pg_stat_user_tables
+                             WHERE relid = 'messages_utc'::regclass;
+                             """)
+
+# Wraps a query of (day, messages) buckets to fill buckets without messages with 0s, from the first bucket
+# to the last, or to the first plus min_span if that is later.
+dense_counts_sql = """
+                   WITH b AS ({buckets})
+                   SELECT g.day, coalesce(b.messages, 0) AS messages
+                   FROM (SELECT min(day) AS lo, greatest(max(day), min(day) + interval '{min_span}') AS hi
+                         FROM b) AS r,
+                        generate_series(r.lo, r.hi, interval '1 {step}') AS g(day)
+                        LEFT JOIN b USING (day)
+                   ORDER BY g.day
+                   """
+
+# Full-text matches for lexical queries. OFFSET 0 keeps the planner from flattening the subquery into the outer
+# filters, so the GIN index is probed first instead of being mis-costed against date or user conditions.
+lquery_source = """(SELECT date, from_user, type
+                    FROM messages_utc
+                    WHERE text_index_col @@ to_tsquery(:lquery)
+                    OFFSET 0) AS hits"""
+
+# Date is filled in with its dashes escaped, digits don't need escaping
+random_message_template = "*On {date}, {user} gave these words of wisdom:*\n{text}\n"
+
+# Connection shared by all queries made while handling one request, see StatsRunner.connect
+request_con: ContextVar[Union[Connection, None]] = ContextVar('request_con', default=None)
+
+week_days = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+# Message types accepted by -mtype
+message_types = ('text', 'sticker', 'photo', 'animation', 'video', 'voice', 'location', 'video_note',
+                 'audio', 'document', 'poll')
+
+# Service message types left out of message type statistics
+excluded_types = ('new_chat_members', 'left_chat_member', 'new_chat_photo', 'new_chat_title', 'migrate_from_group',
+                  'pinned_message')
+
 
 def output_fig(fig: Figure) -> BytesIO:
+    """
+    Render figure with Agg and encode the raw buffer with Pillow.
+    A low zlib level is much faster than savefig's PNG writer for a small size penalty.
+    Figures are opaque, so the alpha channel is dropped before compressing a quarter less data.
+    """
+    fig.set_dpi(200)  # Default figure size at 200 dpi is 1280 px wide, the largest size Telegram keeps
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
     bio = BytesIO()
     bio.name = 'plot.png'
-    fig.savefig(bio, bbox_inches='tight', dpi=200, format='png')
+    image = Image.fromarray(np.asarray(canvas.buffer_rgba()), 'RGBA').convert('RGB')
+    image.save(bio, format='PNG', compress_level=1)
     bio.seek(0)
     return bio
 
 
+class FigurePool(object):
+    """
+    Figures kept for reuse between plots, so each request doesn't build a new figure and canvas.
+    Figures are cleared when released. One that isn't released (e.g. after an exception) is just garbage collected.
+    """
+
+    def __init__(self, maxsize: int = 4):
+        self.figures = queue.LifoQueue(maxsize)
+
+    def get(self, figsize: Tuple[float, float] = None) -> Figure:
+        try:
+            fig = self.figures.get_nowait()
+        except queue.Empty:
+            fig = Figure()
+        fig.set_layout_engine('constrained')  # Reset in case the last plot switched to tight_layout
+        fig.set_size_inches(figsize or matplotlib.rcParams['figure.figsize'])
+        return fig
+
+    def release(self, fig: Figure):
+        fig.clear()
+        try:
+            self.figures.put_nowait(fig)
+        except queue.Full:
+            pass
+
+
+def read_sql(con: Connection, query, params: dict = None, index_col: str = None, counts: Tuple[str, ...] = ()) \
+        -> pd.DataFrame:
+    """
+    Read query results into a DataFrame using psycopg's binary result format on the SQLAlchemy connection,
+    which skips text parsing of every value. Timezone-aware columns are converted to UTC like pd.read_sql_query.
+    :param counts: Message count columns, downcast to the smallest unsigned integer type that fits
+    """
+    compiled = query.compile(dialect=con.dialect)
+    with con.connection.driver_connection.cursor(binary=True) as cur:
+        cur.execute(compiled.string, compiled.construct_params(params))
+        df = pd.DataFrame.from_records(cur.fetchall(), columns=[col.name for col in cur.description],
+                                       coerce_float=True)
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.DatetimeTZDtype):
+            df[col] = df[col].dt.tz_convert('UTC')
+    for col in counts:
+        df[col] = pd.to_numeric(df[col], downcast='unsigned')
+    if index_col:
+        df = df.set_index(index_col)
+    return df
+
+
+def format_cell(value) -> str:
+    """Format floats to one decimal place, missing values as NaN and everything else with str."""
+    if value is None or pd.isna(value):
+        return "NaN"
+    if isinstance(value, float):
+        return f"{value:.1f}"
+    return str(value)
+
+
+def format_table(columns: List[str], rows: List[List[str]]) -> str:
+    """Right-align string cells under their column headers, like DataFrame.to_string(index=False)."""
+    widths = [max(len(cell) for cell in column) for column in zip(columns, *rows)]
+    return '\n'.join('  '.join(cell.rjust(width) for cell, width in zip(row, widths))
+                     for row in [columns, *rows])
+
+
+def format_series(items: List[Tuple[str, str]]) -> str:
+    """Left-align labels and right-align values, like Series.to_string(header=False)."""
+    items = [(str(label), value) for label, value in items]  # Users without a username are labelled None
+    label_width = max(len(label) for label, _ in items)
+    value_width = max(len(value) for _, value in items)
+    return '\n'.join(f"{label.ljust(label_width)}   {value.rjust(value_width)}" for label, value in items)
+
+
+class ArgSpec(NamedTuple):
+    name: str
+    kind: str  # 'user' (-me/-user), 'autouser' (-user, defaults to caller), 'flag' or 'option'
+    type: Any = None
+    default: Any = None
+    help: Union[str, None] = None
+
+
+class CommandSpec(NamedTuple):
+    name: str
+    method: str
+    help: str
+    args: List[ArgSpec]
+
+
+command_specs: List[CommandSpec] = []
+
+
+def stats_command(name: str):
+    """
+    Register a StatsRunner method as a /stats subcommand.
+    Its signature and docstring are read once at import, so building a parser needs no introspection.
+    :param name: Subcommand name
+    """
+    def decorator(method):
+        doc = inspect.getdoc(method).splitlines()
+        param_docs = {match.group(1): match.group(2) for match in map(param_match.match, doc) if match}
+
+        args = []
+        for arg in inspect.signature(method).parameters.values():
+            if arg.name in ('self', 'kwargs'):
+                continue
+            elif arg.name in ('user', 'autouser'):
+                args.append(ArgSpec(arg.name, arg.name))
+            elif arg.annotation == bool:
+                args.append(ArgSpec(arg.name, 'flag', help=param_docs.get(arg.name)))
+            else:
+                args.append(ArgSpec(arg.name, 'option', arg.annotation, arg.default, param_docs.get(arg.name)))
+
+        command_specs.append(CommandSpec(name, method.__name__, doc[0], args))
+        return method
+    return decorator
+
+
+def cached_stats(method):
+    """
+    Memoize a StatsRunner method for a few minutes, keyed by its arguments.
+    Counts change slowly, so repeated commands don't need to rescan the database or redraw plots.
+    Images are cached as bytes and every caller gets its own BytesIO.
+    """
+    def run(self, args, kwargs):
+        text, image = method(self, *args, **kwargs)
+        return text, image.getvalue() if image is not None else None
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        try:
+            result = self.stats_cache[key]
+        except KeyError:
+            # Identical requests arriving while this one runs wait for its result instead of querying again
+            result = self.inflight.do(key, lambda: run(self, args, kwargs))
+            self.stats_cache[key] = result
+        text, image = result
+        if image is None:
+            return result
+        return text, BytesIO(image)
+    return wrapper
+
+
 class HelpException(Exception):
     def __init__(self, msg: str = None):
         self.msg = msg
@@ -80,30 +335,127 @@ class InternalParser(argparse.ArgumentParser):
 
 
 class StatsRunner(object):
-    allowed_methods = {'counts': "get_chat_counts",
-                       'count-dist': 'get_chat_ecdf',
-                       'hours': "get_counts_by_hour",
-                       'days': "get_counts_by_day",
-                       'week': "get_week_by_hourday",
-                       'history': "get_message_history",
-                       'titles': 'get_title_history',
-                       'user': 'get_user_summary',
-                       'corr': "get_user_correlation",
-                       'delta': "get_message_deltas",
-                       'types': "get_type_stats",
-                       'words': "get_word_stats",
-                       'random': "get_random_message"}
-
     def __init__(self, engine: Engine, tz: str = 'Etc/UTC'):
         self.engine = engine
         self.tz = tz
 
-        self.users: Dict[int, Tuple[str, str]] = self.get_db_users()
+        self.escaped_usernames: Dict[int, str] = {}
+        self.usernames = pd.Series(dtype=object, name='user')
+        self.users = self.get_db_users()
         self.users_lock = Lock()
+        self.stats_cache = TTLCache(ttl=300, maxsize=128)
+        self.inflight = SingleFlight()
+        self.figure_pool = FigurePool()
+        self.message_id_bounds: Tuple[Union[int, None], Union[int, None]] = (None, None)
+        self.messages_changes: Union[int, None] = None  # messages_utc write count at the last view refresh
+
+        self.refresh_views()
+
+        self.parser: InternalParser = get_parser(self)  # Signatures and docs don't change, so build once
+
+    @property
+    def users(self) -> Dict[int, Tuple[str, str]]:
+        """Mapping of user ids to (username, display name)."""
+        return self._users
+
+    @users.setter
+    def users(self, users: Dict[int, Tuple[str, str]]):
+        self._users = users
+        # Markdown-escaped usernames without @, kept in sync so lookups don't re-escape every time
+        self.escaped_usernames = {user_id: escape_markdown(username or '').lstrip('@')
+                                  for user_id, (username, _) in users.items()}
+        # @usernames by user id, for joining onto query results
+        self.usernames = pd.Series({user_id: username for user_id, (username, _) in users.items()},
+                                   dtype=object, name='user')
+
+    @contextmanager
+    def connect(self) -> Iterator[Connection]:
+        """
+        Use the connection bound to the current context (e.g. a single /stats request) if there is one,
+        otherwise check out a pooled connection and bind it for the duration of the block.
+        """
+        con = request_con.get()
+        if con is not None:
+            yield con
+            return
+
+        with self.engine.connect() as con:
+            token = request_con.set(con)
+            try:
+                yield con
+            finally:
+                request_con.reset(token)
+
+    def refresh_views(self):
+        """
+        Refresh the pre-aggregated message counts and the message id range used to sample random messages.
+        The views are fully recomputed, so this is skipped when messages_utc had no writes since the last refresh.
+        Cached stats are dropped, since newly logged messages only become visible to the views now.
+        """
+        with self.engine.begin() as con:
+            # Message ids aren't unique or monotonic (migrated chats, imports), so track the table's write counters
+            changes = con.execute(messages_changes_query).scalar()
+            if changes is not None and changes == self.messages_changes:
+                return
+            refresh_views(con)
+            self.messages_changes = changes
+            self.message_id_bounds = tuple(con.execute(text("SELECT min(message_id), max(message_id) "
+                                                            "FROM messages_utc;")).fetchone())
+        self.stats_cache.clear()
+
+    @staticmethod
+    def _count_source(lquery: Union[str, None], sql_dict: dict, view: Union[str, None] = 'messages_hourly',
+                      freq: str = 'h') -> Tuple[str, str]:
+        """
+        Returns table and count expression for message counts.
+        The pre-aggregated view can't answer lexical queries or date limits that fall inside its buckets.
+        Lexical queries read from the full-text matches instead of the whole table.
+        """
+        if lquery:
+            return lquery_source, 'count(*)'
+        if view and all(sql_dict[key] == sql_dict[key].floor(freq)
+                              for key in ('start_dt', 'end_dt') if sql_dict.get(key) is not None):
+            return view, 'sum(cnt)'
+        return 'messages_utc', 'count(*)'
+
+    @staticmethod
+    def _build_where(sql_dict: dict, lquery: str = None, mtype: str = None, start: str = None, end: str = None,
+                     user: Tuple[int, str] = None, prefix: str = 'WHERE') -> str:
+        """
+        Returns filter clause for message queries, adding its bind parameters to sql_dict.
+        Returns an empty string if there are no filters.
+        lquery is only bound here, the query must read from the source given by _count_source.
+        """
+        query_conditions = []
+
+        if lquery:
+            sql_dict['lquery'] = lquery
+
+        if mtype:
+            if mtype not in message_types:
+                raise HelpException(f'mtype {mtype} is invalid.')
+            sql_dict['mtype'] = mtype
+            query_conditions.append("type = :mtype")
+
+        if start:
+            sql_dict['start_dt'] = pd.to_datetime(start)
+            query_conditions.append("date >= :start_dt")
+
+        if end:
+            sql_dict['end_dt'] = pd.to_datetime(end)
+            query_conditions.append("date < :end_dt")
+
+        if user:
+            sql_dict['user'] = user[0]
+            query_conditions.append("from_user = :user")
+
+        if not query_conditions:
+            return ""
+        return f"{prefix} {' AND '.join(query_conditions)}"
 
     def get_message_user_ids(self) -> List[int]:
         """Returns list of unique user ids from messages in database."""
-        with self.engine.connect() as con:
+        with self.connect() as con:
             result = con.execute(text("SELECT DISTINCT from_user FROM messages_utc;"))
         return [user for user, in result.fetchall() if user is not None]
 
@@ -120,7 +472,7 @@ class StatsRunner(object):
         where t.rn = 1
         """
 
-        with self.engine.connect() as con:
+        with self.connect() as con:
             result = con.execute(text(query))
         result = result.fetchall()
 
@@ -131,23 +483,35 @@ class StatsRunner(object):
         Updates user names table with user_dict
         :param user_dict: mapping of user ids to (username, display name)
         """
-        for uid in user_dict:
-            username, display_name = user_dict[uid]
-            sql_dict = {'uid': uid, 'username': username, 'display_name': display_name}
-            update_query = """
-                UPDATE user_names
-                SET username = :username
-                WHERE user_id = :uid AND username IS DISTINCT FROM :username;
-            """
-            insert_query = """
-                INSERT INTO user_names(user_id, date, username, display_name)
-                VALUES (:uid, current_timestamp, :username, :display_name);
-            """
-            with self.engine.connect() as con:
-                con.execute(text(update_query), sql_dict)
-                if display_name:
-                    con.execute(text(insert_query), sql_dict)
+        if not user_dict:
+            return
+
+        sql_dict = {'uids': list(user_dict), 'usernames': [username for username, _ in user_dict.values()]}
+        # Only users with a new display name get a new row
+        new_names = [(uid, username, display_name) for uid, (username, display_name) in user_dict.items()
+                     if display_name]
+        insert_dict = {key: list(column) for key, column in zip(('uids', 'usernames', 'display_names'),
+                                                                 zip(*new_names))}
+
+        update_query = """
+            UPDATE user_names
+            SET username = u.username
+            FROM unnest(CAST(:uids AS bigint[]), CAST(:usernames AS text[])) AS u(user_id, username)
+            WHERE user_names.user_id = u.user_id AND user_names.username IS DISTINCT FROM u.username;
+        """
+        insert_query = """
+            INSERT INTO user_names(user_id, date, username, display_name)
+            SELECT user_id, current_timestamp, username, display_name
+            FROM unnest(CAST(:uids AS bigint[]), CAST(:usernames AS text[]), CAST(:display_names AS text[]))
+                AS u(user_id, username, display_name);
+        """
+        with self.engine.begin() as con:
+            con.execute(text(update_query), sql_dict)
+            if new_names:
+                con.execute(text(insert_query), insert_dict)
 
+    @stats_command('counts')
+    @cached_stats
     def get_chat_counts(self, n: int = 20, lquery: str = None, mtype: str = None, start: str = None, end: str = None) \
             -> Tuple[Union[str, None], Union[None, BytesIO]]:
         """
@@ -159,62 +523,51 @@ class StatsRunner(object):
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         """
         sql_dict = {}
-        query_conditions = []
 
         if n <= 0:
             raise HelpException(f'n must be greater than 0, got: {n}')
 
-        if lquery:
-            query_conditions.append(f"text_index_col @@ to_tsquery( {random_quote(lquery)} )")
-
-        if mtype:
-            if mtype not in ('text', 'sticker', 'photo', 'animation', 'video', 'voice', 'location', 'video_note',
-                             'audio', 'document', 'poll'):
-                raise HelpException(f'mtype {mtype} is invalid.')
-            query_conditions.append(f"""type = '{mtype}'""")
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
-
-        query_where = ""
-        if query_conditions:
-            query_where = f"WHERE {' AND '.join(query_conditions)}"
+        query_where = self._build_where(sql_dict, lquery=lquery, mtype=mtype, start=start, end=end)
 
+        sql_dict['n'] = n
+        source, _ = self._count_source(lquery, sql_dict, view=None)
         query = f"""
-                    SELECT "from_user", COUNT(*) as "count"
-                    FROM "messages_utc"
+                    SELECT "from_user", COUNT(*) as "count",
+                           (100.0 * COUNT(*) / SUM(COUNT(*)) OVER ())::float as "percent"
+                    FROM {source}
                     {query_where}
                     GROUP BY "from_user"
-                    ORDER BY "count" DESC;
+                    ORDER BY "count" DESC, "from_user"
+                    LIMIT :n;
                 """
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict, index_col='from_user')
+        with self.connect() as con:
+            df = read_sql(con, text(query), sql_dict, index_col='from_user', counts=('count',))
 
         if len(df) == 0:
             return "No matching messages", None
 
-        user_df = pd.Series(self.users, name="user")
-        user_df = user_df.apply(lambda x: x[0])  # Take only @usernames
-        df = df.join(user_df)
-        df['Percent'] = df['count'] / df['count'].sum() * 100
-        df = df[['user', 'count', 'Percent']]
+        df = df.join(self.usernames)
+        # Users without a username (or not in user_names) fall back to their display name, then their id
+        missing = df['user'].isna()
+        df.loc[missing, 'user'] = [self.users.get(user_id, (None, None))[1] or str(user_id)
+                                   for user_id in df.index[missing]]
+        df = df[['user', 'count', 'percent']]
         if mtype:
             df.columns = ['User', mtype, 'Percent']
         elif lquery:
             df.columns = ['User', 'lquery', 'Percent']
         else:
             df.columns = ['User', 'Total Messages', 'Percent']
-        df['User'] = df['User'].str.replace(r'[^\x00-\x7F]|[@]', "", regex=True)  # Drop emoji and @
+        df['User'] = df['User'].str.replace(non_ascii_at_match, "", regex=True)  # Drop emoji and @
 
-        out_text = df.iloc[:n].to_string(index=False, header=True, float_format=lambda x: f"{x:.1f}")
+        rows = [[format_cell(user), str(count), format_cell(percent)]
+                for user, count, percent in df.itertuples(index=False)]
+        out_text = format_table(list(df.columns), rows)
 
         return f"```\n{out_text}\n```", None
 
+    @stats_command('count-dist')
+    @cached_stats
     def get_chat_ecdf(self, lquery: str = None, mtype: str = None, start: str = None, end: str = None,
                       log: bool = False) -> Tuple[Union[str, None], Union[None, BytesIO]]:
         """
@@ -226,47 +579,35 @@ class StatsRunner(object):
         :param log: Plot with log scale.
         """
         sql_dict = {}
-        query_conditions = []
-
-        if lquery:
-            query_conditions.append(f"text_index_col @@ to_tsquery( {random_quote(lquery)} )")
-
-        if mtype:
-            if mtype not in ('text', 'sticker', 'photo', 'animation', 'video', 'voice', 'location', 'video_note',
-                             'audio', 'document', 'poll'):
-                raise HelpException(f'mtype {mtype} is invalid.')
-            query_conditions.append(f"""type = '{mtype}'""")
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
+        query_where = self._build_where(sql_dict, lquery=lquery, mtype=mtype, start=start, end=end)
 
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
-
-        query_where = ""
-        if query_conditions:
-            query_where = f"WHERE {' AND '.join(query_conditions)}"
+        source, _ = self._count_source(lquery, sql_dict, view=None)
 
+        # Cumulative number of users at or below each distinct message count
         query = f"""
-                    SELECT "from_user", COUNT(*) as "count"
-                    FROM "messages_utc"
-                    {query_where}
-                    GROUP BY "from_user"
-                    ORDER BY "count" DESC;
+                    SELECT "count", SUM(COUNT(*)) OVER (ORDER BY "count") as "users"
+                    FROM (SELECT COUNT(*) as "count"
+                          FROM {source}
+                          {query_where}
+                          GROUP BY "from_user") AS t
+                    GROUP BY "count"
+                    ORDER BY "count";
                 """
 
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict)
+        with self.connect() as con:
+            df = read_sql(con, text(query), sql_dict, counts=('count', 'users'))
 
         if len(df) == 0:
             return "No matching messages", None
 
-        fig = Figure(constrained_layout=True)
+        fig = self.figure_pool.get()
         subplot = fig.subplots()
 
-        sns.ecdfplot(df, y='count', stat='count', log_scale=log, ax=subplot)
+        # Same steps as an ECDF of per-user counts: each count spans the users that sent it
+        subplot.step(np.r_[0, df['users']], np.r_[df['count'].iloc[0], df['count']], where='pre')
+        subplot.margins(x=0)
+        if log:
+            subplot.set_yscale('log')
         subplot.set_xlabel('User')
         subplot.set_ylabel('Messages')
 
@@ -278,9 +619,12 @@ class StatsRunner(object):
         sns.despine(fig=fig)
 
         bio = output_fig(fig)
+        self.figure_pool.release(fig)
 
         return None, bio
 
+    @stats_command('hours')
+    @cached_stats
     def get_counts_by_hour(self, user: Tuple[int, str] = None, lquery: str = None, start: str = None, end: str = None) \
             -> Tuple[Union[str, None], Union[None, BytesIO]]:
         """
@@ -289,49 +633,28 @@ class StatsRunner(object):
         :param start: Start timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         """
-        query_conditions = []
         sql_dict = {}
+        query_where = self._build_where(sql_dict, lquery=lquery, start=start, end=end, user=user)
 
-        if lquery:
-            query_conditions.append(f"text_index_col @@ to_tsquery( {random_quote(lquery)} )")
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
-
-        if user:
-            sql_dict['user'] = user[0]
-            query_conditions.append("from_user = :user")
+        source, count = self._count_source(lquery, sql_dict)
 
-        query_where = ""
-        if query_conditions:
-            query_where = f"WHERE {' AND '.join(query_conditions)}"
+        buckets = f"""
+                   SELECT date_trunc('hour', date) as day, {count} as messages
+                   FROM {source}
+                   {query_where}
+                   GROUP BY day
+                   """
+        # Insert 0s for periods with no messages, covering at least 24 hours
+        query = dense_counts_sql.format(buckets=buckets, step='hour', min_span='23 hours')
 
-        query = f"""
-                 SELECT date_trunc('hour', date) as day, count(*) as messages
-                 FROM messages_utc
-                 {query_where}
-                 GROUP BY day
-                 ORDER BY day
-                 """
-
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict)
+        with self.connect() as con:
+            df = read_sql(con, text(query), sql_dict, counts=('messages',))
 
         if len(df) == 0:
             return "No matching messages", None
 
-        df['day'] = pd.to_datetime(df.day)
         df['day'] = df.day.dt.tz_convert(self.tz)
         df = df.set_index('day')
-        df = df.asfreq('h', fill_value=0)  # Insert 0s for periods with no messages
-
-        if (df.index.max() - df.index.min()) < pd.Timedelta('24 hours'):  # Deal with data covering < 24 hours
-            df = df.reindex(pd.date_range(df.index.min(), periods=24, freq='h'))
 
         df['hour'] = df.index.hour
 
@@ -340,14 +663,16 @@ class StatsRunner(object):
             df = df.groupby('hour').resample('7D').sum().drop(columns='hour')
             df['hour'] = df.index.get_level_values('hour')
 
-        fig = Figure(constrained_layout=True)
+        fig = self.figure_pool.get()
         subplot = fig.subplots()
 
-        plot_common_kwargs = dict(x='hour', y='messages', hue='hour', data=df, ax=subplot, legend=False,
-                                  palette='flare')
-        sns.stripplot(jitter=.4, size=2, alpha=.5, zorder=1, **plot_common_kwargs)
-        sns.boxplot(whis=1, showfliers=False, whiskerprops={"zorder": 10}, boxprops={"zorder": 10}, zorder=10,
-                    **plot_common_kwargs)
+        # Jittered points drawn as one scatter, which is much cheaper than stripplot for multi-year ranges
+        palette = np.array(sns.color_palette('flare', 24))
+        jitter = np.random.default_rng().uniform(-.4, .4, len(df))
+        subplot.scatter(df['hour'] + jitter, df['messages'], s=4, c=palette[df['hour']], alpha=.5, linewidths=0,
+                        zorder=1)
+        sns.boxplot(x='hour', y='messages', hue='hour', data=df, ax=subplot, legend=False, palette='flare', whis=1,
+                    showfliers=False, whiskerprops={"zorder": 10}, boxprops={"zorder": 10}, zorder=10)
 
         subplot.set_ylim(bottom=0, top=df['messages'].quantile(0.999, interpolation='higher'))
 
@@ -367,9 +692,12 @@ class StatsRunner(object):
         sns.despine(fig=fig)
 
         bio = output_fig(fig)
+        self.figure_pool.release(fig)
 
         return None, bio
 
+    @stats_command('days')
+    @cached_stats
     def get_counts_by_day(self, user: Tuple[int, str] = None, lquery: str = None, start: str = None, end: str = None,
                           plot: str = None) -> Tuple[Union[str, None], Union[None, BytesIO]]:
         """
@@ -379,54 +707,34 @@ class StatsRunner(object):
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param plot: Type of plot. ('box' or 'violin')
         """
-        query_conditions = []
         sql_dict = {}
+        query_where = self._build_where(sql_dict, lquery=lquery, start=start, end=end, user=user)
 
-        if lquery:
-            query_conditions.append(f"text_index_col @@ to_tsquery( {random_quote(lquery)} )")
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
+        source, count = self._count_source(lquery, sql_dict)
 
-        if user:
-            sql_dict['user'] = user[0]
-            query_conditions.append("from_user = :user")
-
-        query_where = ""
-        if query_conditions:
-            query_where = f"WHERE {' AND '.join(query_conditions)}"
-
-        query = f"""
+        buckets = f"""
                      SELECT date_trunc('day', date)
-                         as day, count(*) as messages
-                     FROM messages_utc
+                         as day, {count} as messages
+                     FROM {source}
                      {query_where}
                      GROUP BY day
-                     ORDER BY day
-                 """
+                   """
+        # Fill periods with no messages, covering at least 7 days
+        query = dense_counts_sql.format(buckets=buckets, step='day', min_span='6 days')
 
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict)
+        with self.connect() as con:
+            df = read_sql(con, text(query), sql_dict, counts=('messages',))
 
         if len(df) == 0:
             return "No matching messages", None
 
-        df['day'] = pd.to_datetime(df.day)
         df['day'] = df.day.dt.tz_convert(self.tz)
         df = df.set_index('day')
-        df = df.asfreq('d', fill_value=0)  # Fill periods with no messages
-        if (df.index.max() - df.index.min()) < pd.Timedelta('7 days'):  # Deal with data covering < 7 days
-            df = df.reindex(pd.date_range(df.index.min(), periods=7, freq='d'))
         df['dow'] = df.index.weekday
         df['day_name'] = df.index.day_name()
         df = df.sort_values('dow')  # Make sure start is Monday
 
-        fig = Figure(constrained_layout=True)
+        fig = self.figure_pool.get()
         subplot = fig.subplots()
         if plot == 'box':
             sns.boxplot(x='day_name', y='messages', data=df, whis=1, showfliers=False, ax=subplot)
@@ -449,9 +757,12 @@ class StatsRunner(object):
         sns.despine(fig=fig)
 
         bio = output_fig(fig)
+        self.figure_pool.release(fig)
 
         return None, bio
 
+    @stats_command('week')
+    @cached_stats
     def get_week_by_hourday(self, lquery: str = None, user: Tuple[int, str] = None, start: str = None, end: str = None) \
             -> Tuple[Union[str, None], Union[None, BytesIO]]:
         """
@@ -460,55 +771,33 @@ class StatsRunner(object):
         :param start: Start timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         """
-        query_conditions = []
         sql_dict = {}
+        query_where = self._build_where(sql_dict, lquery=lquery, start=start, end=end, user=user)
 
-        if lquery:
-            query_conditions.append(f"text_index_col @@ to_tsquery( {random_quote(lquery)} )")
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
-
-        if user:
-            sql_dict['user'] = user[0]
-            query_conditions.append("from_user = :user")
-
-        query_where = ""
-        if query_conditions:
-            query_where = f"WHERE {' AND '.join(query_conditions)}"
+        source, count = self._count_source(lquery, sql_dict)
 
+        sql_dict['tz'] = self.tz
+        # One column per day of the week (isodow 1 is Monday), so only the 24 x 7 table is transferred
+        day_columns = ', '.join(f'coalesce({count} FILTER (WHERE extract(isodow FROM date AT TIME ZONE :tz) = {n}), 0) '
+                                f'as "{day}"'
+                                for n, day in enumerate(week_days, start=1))
         query = f"""
-                     SELECT date_trunc('hour', date)
-                         as msg_time, count(*) as messages
-                     FROM messages_utc
+                     SELECT extract(hour FROM date AT TIME ZONE :tz)::integer as hour,
+                            {day_columns}
+                     FROM {source}
                      {query_where}
-                     GROUP BY msg_time
-                     ORDER BY msg_time
+                     GROUP BY hour
+                     ORDER BY hour
                  """
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict)
+        with self.connect() as con:
+            df = read_sql(con, text(query), sql_dict, index_col='hour', counts=week_days)
 
         if len(df) == 0:
             return "No matching messages", None
 
-        df['msg_time'] = pd.to_datetime(df.msg_time)
-        df['msg_time'] = df.msg_time.dt.tz_convert(self.tz)
-        df = df.set_index('msg_time')
-        df = df.asfreq('h', fill_value=0)  # Fill periods with no messages
-        df['dow'] = df.index.weekday
-        df['hour'] = df.index.hour
-        df['day_name'] = df.index.day_name()
-        df_grouped = df[['messages', 'hour', 'day_name']].groupby(['hour', 'day_name']).sum().unstack()
-        df_grouped = df_grouped.loc[:, 'messages']
-        df_grouped = df_grouped.reindex(columns=['Monday', 'Tuesday', 'Wednesday', 'Thursday',
-                                                 'Friday', 'Saturday', 'Sunday'])
+        df_grouped = df.reindex(range(24), fill_value=0)  # Hours without any messages
 
-        fig = Figure(constrained_layout=True)
+        fig = self.figure_pool.get()
         ax = fig.subplots()
 
         sns.heatmap(df_grouped.T, yticklabels=['M', 'T', 'W', 'Th', 'F', 'Sa', 'Su'], linewidths=.5,
@@ -525,9 +814,12 @@ class StatsRunner(object):
             ax.set_title("Total messages by day and hour")
 
         bio = output_fig(fig)
+        self.figure_pool.release(fig)
 
         return None, bio
 
+    @stats_command('history')
+    @cached_stats
     def get_message_history(self, user: Tuple[int, str] = None, lquery: str = None, averages: int = None,
                             start: str = None,
                             end: str = None) \
@@ -539,51 +831,33 @@ class StatsRunner(object):
         :param start: Start timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         """
-        query_conditions = []
         sql_dict = {}
 
         if averages:
             if averages < 0:
                 raise HelpException("averages must be >= 0")
 
-        if lquery:
-            query_conditions.append(f"text_index_col @@ to_tsquery( {random_quote(lquery)} )")
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
-
-        if user:
-            sql_dict['user'] = user[0]
-            query_conditions.append("from_user = :user")
+        query_where = self._build_where(sql_dict, lquery=lquery, start=start, end=end, user=user)
 
-        query_where = ""
-        if query_conditions:
-            query_where = f"WHERE {' AND '.join(query_conditions)}"
+        source, count = self._count_source(lquery, sql_dict)
 
-        query = f"""
+        buckets = f"""
                     SELECT date_trunc('day', date)
-                        as day, count(*) as messages
-                    FROM messages_utc
+                        as day, {count} as messages
+                    FROM {source}
                     {query_where}
                     GROUP BY day
-                    ORDER BY day
-                 """
+                   """
+        query = dense_counts_sql.format(buckets=buckets, step='day', min_span='0 days')
 
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict)
+        with self.connect() as con:
+            df = read_sql(con, text(query), sql_dict, counts=('messages',))
 
         if len(df) == 0:
             return "No matching messages", None
 
-        df['day'] = pd.to_datetime(df.day)
         df['day'] = df.day.dt.tz_convert(self.tz)
         df = df.set_index('day')
-        df = df.resample('1D').sum()
 
         if averages is None:
             averages = len(df) // 20
@@ -595,7 +869,7 @@ class StatsRunner(object):
         else:
             alpha = 1
 
-        fig = Figure(constrained_layout=True)
+        fig = self.figure_pool.get()
         subplot = fig.subplots()
         df.plot(y='messages', alpha=alpha, legend=False, ax=subplot)
         if averages:
@@ -612,9 +886,12 @@ class StatsRunner(object):
         fig.tight_layout()
 
         bio = output_fig(fig)
+        self.figure_pool.release(fig)
 
         return None, bio
 
+    @stats_command('titles')
+    @cached_stats
     def get_title_history(self, start: str = None, end: str = None, duration: bool = False) \
             -> Tuple[Union[str, None], Union[None, BytesIO]]:
         """
@@ -623,20 +900,8 @@ class StatsRunner(object):
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param duration: If true, order by duration instead of time.
         """
-        query_conditions = []
         sql_dict = {}
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
-
-        query_where = ""
-        if query_conditions:
-            query_where = f"AND {' AND '.join(query_conditions)}"
+        query_where = self._build_where(sql_dict, start=start, end=end, prefix='AND')
 
         query = f"""
                     SELECT date, new_chat_title
@@ -645,27 +910,28 @@ class StatsRunner(object):
                     ORDER BY date;
                  """
 
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict)
+        with self.connect() as con:
+            df = read_sql(con, text(query), sql_dict)
 
         if len(df) == 0:
             return "No chat titles in range", None
 
         df['idx'] = np.arange(len(df))
-        df['diff'] = -df['date'].diff(-1)
-        df['end'] = df['date'] + df['diff']
 
         if end:
             last = pd.Timestamp(sql_dict['end_dt'], tz=self.tz).tz_convert('utc')
         else:
             last = pd.Timestamp(datetime.utcnow(), tz='utc')
 
-        df_end = df['end']
-        df_end.iloc[-1] = last
-        df.loc[:, 'end'] = df_end
-        df.loc[:, 'diff'].iloc[-1] = df.iloc[-1]['end'] - df.iloc[-1]['date']
+        # Each title ends when the next one starts, the last one at the end of the range
+        dates = df['date'].dt.tz_convert('utc').to_numpy(dtype='datetime64[ns]')
+        ends = np.empty_like(dates)
+        ends[:-1] = dates[1:]
+        ends[-1] = last.tz_localize(None).to_datetime64()
+        df['end'] = pd.DatetimeIndex(ends, tz='utc')
+        df['diff'] = ends - dates
 
-        fig = Figure(constrained_layout=True, figsize=(12, 1+0.15 * len(df)))
+        fig = self.figure_pool.get(figsize=(12, 1+0.15 * len(df)))
         ax = fig.subplots()
 
         if duration:
@@ -689,17 +955,17 @@ class StatsRunner(object):
 
             ax.scatter(x, y, zorder=4, color=sns.color_palette()[1])
 
-            titles = list(zip(df.date.apply(date2num),
-                              df.end.apply(date2num) - df.date.apply(date2num)))
+            starts = date2num(dates)
+            widths = date2num(ends) - starts
 
-            for n, i in enumerate(titles):
-                ax.broken_barh([i], (n, 1))
-                ax.annotate(df.new_chat_title[n], xy=(i[0] + i[1], n), xycoords='data',
+            ax.barh(df.idx, widths, left=starts, height=1, align='edge')
+            for n, (title, end_num) in enumerate(zip(df.new_chat_title, starts + widths)):
+                ax.annotate(title, xy=(end_num, n), xycoords='data',
                             xytext=(10, 0), textcoords='offset points',
                             horizontalalignment='left', verticalalignment='bottom')
 
             ax.set_ylim(-1, (df.idx.max() + 1))
-            ax.set_xlim(titles[0][0] - 1, None)
+            ax.set_xlim(starts[0] - 1, None)
 
             ax.margins(0.2)
             ax.set_ylabel("")
@@ -710,9 +976,11 @@ class StatsRunner(object):
             sns.despine(fig=fig, left=True)
 
         bio = output_fig(fig)
+        self.figure_pool.release(fig)
 
         return None, bio
 
+    @stats_command('user')
     def get_user_summary(self, autouser=None, **kwargs) -> Tuple[Union[str, None], Union[None, BytesIO]]:
         """
         Get summary of a user.
@@ -720,43 +988,28 @@ class StatsRunner(object):
         user: Tuple[int, str] = kwargs['user']
         sql_dict = {'user': user[0]}
 
-        count_query = """
-                         SELECT COUNT(*)
-                         FROM "messages_utc"
-                         WHERE from_user = :user;
-                      """
-
-        days_query = """
-                        SELECT EXTRACT(epoch FROM(NOW() - MIN(date))) / 86400 as "days"
-                        FROM "messages_utc"
-                        WHERE from_user = :user;
-                     """
+        # One round trip: each CTE returns exactly one row
+        query = """
+                   WITH m AS (SELECT COUNT(*) AS msg_count,
+                                     EXTRACT(epoch FROM(NOW() - MIN(date))) / 86400 AS days
+                              FROM messages_utc
+                              WHERE from_user = :user),
+                        e AS (SELECT array_agg(date ORDER BY date) AS dates,
+                                     array_agg(event ORDER BY date) AS events
+                              FROM user_events
+                              WHERE user_id = :user),
+                        n AS (SELECT COUNT(*) AS name_count
+                              FROM user_names
+                              WHERE user_id = :user)
+                   SELECT msg_count, days, name_count, dates, events
+                   FROM m, e, n;
+                """
 
-        event_query = """
-                         SELECT date, event
-                         FROM user_events
-                         WHERE user_id = :user
-                         ORDER BY "date";
-                      """
-
-        username_query = """
-                             SELECT COUNT(*)
-                             FROM "user_names"
-                             WHERE user_id = :user;
-                         """
+        with self.connect() as con:
+            msg_count, days, name_count, dates, events = con.execute(text(query), sql_dict).fetchone()
 
-        with self.engine.connect() as con:
-            result = con.execute(text(count_query), sql_dict)
-            msg_count: int = result.fetchall()[0][0]
-            result = con.execute(text(days_query), sql_dict)
-            days: float = result.fetchall()[0][0]
-            result = con.execute(text(event_query), sql_dict)
-            events: list = result.fetchall()
-            result = con.execute(text(username_query), sql_dict)
-            name_count: int = result.fetchall()[0][0]
-
-        event_text = '\n'.join([f'{event.event} on {pd.to_datetime(event.date).tz_convert(self.tz)}'
-                                for event in events])
+        event_text = '\n'.join([f'{event} on {pd.to_datetime(date).tz_convert(self.tz)}'
+                                for date, event in zip(dates or [], events or [])])
 
         # Add separator line
         if event_text:
@@ -774,6 +1027,8 @@ class StatsRunner(object):
 
         return f"User {user[1].lstrip('@')}: ```\n{out_text}\n```", None
 
+    @stats_command('corr')
+    @cached_stats
     def get_user_correlation(self, start: str = None, end: str = None, agg: bool = True, c_type: str = None,
                              n: int = 5, thresh: float = 0.05, autouser=None, **kwargs) -> Tuple[str, None]:
         """
@@ -786,20 +1041,8 @@ class StatsRunner(object):
         :param thresh: Fraction of time bins that have data for both users to be considered valid (0-1)
         """
         user: Tuple[int, str] = kwargs['user']
-        query_conditions = []
         sql_dict = {}
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
-
-        query_where = ""
-        if query_conditions:
-            query_where = f"WHERE {' AND '.join(query_conditions)}"
+        query_where = self._build_where(sql_dict, start=start, end=end)
 
         if n <= 0:
             raise HelpException(f'n must be greater than 0, got: {n}')
@@ -812,62 +1055,96 @@ class StatsRunner(object):
         if not 0 <= thresh <= 1:
             raise HelpException(f'n must be in the range [0, 1], got: {n}')
 
-        query = f"""
-                SELECT msg_time, extract(ISODOW FROM msg_time) as dow, extract(HOUR FROM msg_time) as hour,
-                       "user", messages
-                FROM (
-                         SELECT date_trunc('hour', date)
-                                         as msg_time,
-                                count(*) as messages, from_user as "user"
-                         FROM messages_utc
-                         {query_where}
-                         GROUP BY msg_time, from_user
-                         ORDER BY msg_time
-                     ) t
-                ORDER BY dow, hour;
-                """
+        source, count = self._count_source(None, sql_dict)
+        sql_dict['user'] = user[0]
+        sql_dict['named_users'] = list(self.usernames.index)
+        sql_dict['tz'] = self.tz
+
+        # Hourly counts of users with names, starting from the user's first active hour
+        active_sql = f"""
+                     WITH hourly AS (SELECT date_trunc('hour', date) as msg_time, from_user as "user",
+                                            {count} as messages
+                                     FROM {source}
+                                     {query_where}
+                                     GROUP BY msg_time, from_user),
+                          active AS (SELECT *
+                                     FROM hourly
+                                     WHERE "user" = ANY(CAST(:named_users AS bigint[]))
+                                           AND msg_time >= (SELECT min(msg_time) FROM hourly WHERE "user" = :user))
+                     """
 
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict)
+        if agg:
+            query = f"""
+                    {active_sql}
+                    SELECT extract(ISODOW FROM msg_time AT TIME ZONE :tz)::integer as dow,
+                           extract(HOUR FROM msg_time AT TIME ZONE :tz)::integer as hour,
+                           "user", sum(messages) as messages
+                    FROM active
+                    GROUP BY dow, hour, "user";
+                    """
+        else:
+            # Hours where both users sent messages, as pandas' pairwise corr would use.
+            # Spearman correlates average ranks (ties share the mean rank) computed within each pair.
+            if c_type == 'spearman':
+                pair_values = """
+                              rank() OVER (PARTITION BY "user" ORDER BY me)
+                                  + (count(*) OVER (PARTITION BY "user", me) - 1) / 2.0 as me,
+                              rank() OVER (PARTITION BY "user" ORDER BY other)
+                                  + (count(*) OVER (PARTITION BY "user", other) - 1) / 2.0 as other
+                              """
+            else:
+                pair_values = "me, other"
+            sql_dict['thresh'] = thresh
+            query = f"""
+                    {active_sql},
+                         pairs AS (SELECT o."user", m.messages as me, o.messages as other
+                                   FROM active m
+                                   JOIN active o USING (msg_time)
+                                   WHERE m."user" = :user AND o."user" <> :user),
+                         pair_values AS (SELECT "user", {pair_values} FROM pairs)
+                    SELECT "user",
+                           CASE WHEN count(me) >= greatest(1, floor(:thresh * (SELECT count(DISTINCT msg_time)
+                                                                              FROM active)))
+                                THEN corr(me, other) END as corr
+                    FROM (SELECT DISTINCT "user" FROM active) AS u
+                    LEFT JOIN pair_values USING ("user")
+                    GROUP BY "user";
+                    """
+
+        with self.connect() as con:
+            df = read_sql(con, text(query), sql_dict)
 
         if len(df) == 0:
             return 'No messages in range', None
 
-        df['msg_time'] = pd.to_datetime(df.msg_time)
-        df['msg_time'] = df.msg_time.dt.tz_convert(self.tz)
-
-        # Prune irrelevant messages (not sure if this actually improves performance)
-        user_first_date = df.loc[df.user == user[0], 'msg_time'].iloc[0]
-        df = df.loc[df.msg_time >= user_first_date]
-
-        df = df.set_index('msg_time')
-
-        user_dict = {'user': {user_id: value[0] for user_id, value in self.users.items()}}
-        df = df.loc[df.user.isin(list(user_dict['user'].keys()))]  # Filter out users with no names
-        df = df.replace(user_dict)  # Replace user ids with names
-        df['user'] = df['user'].str.replace(r'[^\x00-\x7F]', "", regex=True)
+        # Strip non-ASCII from the few usernames rather than from every row
+        df['user'] = df['user'].map(self.usernames.str.replace(non_ascii_match, "", regex=True))
 
         if agg:
-            df = df.pivot_table(index=['dow', 'hour'], columns='user', values='messages', aggfunc='sum')
-            corrs = []
-            for other_user in df.columns.values:
-                if df[user[1]].sum() / df[other_user].sum() > thresh:
-                    me_notna = df[user[1]].notna()
-                    other_notna = df[other_user].notna()
-                    idx = me_notna | other_notna
-                    corrs.append(df.loc[idx, user[1]].fillna(0).corr(df.loc[idx, other_user].fillna(0)))
-                else:
-                    corrs.append(pd.NA)
-
-            me = pd.Series(corrs, index=df.columns.values).sort_values(ascending=False).iloc[1:].dropna()
+            # Scatter the counts into a dense hour-of-week x user table, empty cells stay 0
+            bins = (df['dow'].to_numpy(dtype=np.intp) - 1) * 24 + df['hour'].to_numpy(dtype=np.intp)
+            user_idx, names = pd.factorize(df['user'], sort=True)
+            named = user_idx >= 0  # Users without a username get -1, leave them out like groupby did
+            others = np.zeros((7 * 24, len(names)), dtype=np.float64)
+            np.add.at(others, (bins[named], user_idx[named]), df['messages'].to_numpy(dtype=np.float64)[named])
+            mine = others[:, names.get_loc(user[1])]
+
+            # Pearson correlation with every user at once, over the bins where either user has data.
+            # The other user's sums don't need the mask since their values outside it are 0.
+            mask = ((mine != 0)[:, None] | (others != 0)).astype(np.float64)
+            n_bins = mask.sum(axis=0)
+            sum_mine = mine @ mask
+            sum_others = others.sum(axis=0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cov = mine @ others - sum_mine * sum_others / n_bins
+                var_mine = (mine ** 2) @ mask - sum_mine ** 2 / n_bins
+                var_others = (others ** 2).sum(axis=0) - sum_others ** 2 / n_bins
+                corrs = cov / np.sqrt(var_mine * var_others)
+            corrs[~(mine.sum() / sum_others > thresh) | (n_bins < 2)] = np.nan
+
+            me = pd.Series(corrs, index=names).drop(user[1]).sort_values(ascending=False).dropna()
         else:
-            df = df.pivot(columns='user', values='messages')
-
-            if thresh == 0:
-                df_corr = df.corr(method=c_type)
-            else:
-                df_corr = df.corr(method=c_type, min_periods=int(thresh * len(df)))
-            me = df_corr[user[1]].sort_values(ascending=False).iloc[1:].dropna()
+            me = df.set_index('user')['corr'].astype(float).sort_values(ascending=False).dropna()
 
         if len(me) < 1:
             return "`Sorry, not enough data, try with -aggtimes, decrease -thresh, or use a bigger date range.`", None
@@ -875,12 +1152,14 @@ class StatsRunner(object):
         if n > len(me) // 2:
             n = int(len(me) // 2)
 
-        out_text = me.to_string(header=False, float_format=lambda x: f"{x:.3f}")
-        split = out_text.splitlines()
-        out_text = "\n".join(['HIGHEST CORRELATION:'] + split[:n] + ['\nLOWEST CORRELATION:'] + split[-n:])
+        shown = [(name, f"{corr:.3f}") for name, corr in pd.concat([me.iloc[:n], me.iloc[-n:]]).items()]
+        split = format_series(shown).splitlines()
+        out_text = "\n".join(['HIGHEST CORRELATION:'] + split[:n] + ['\nLOWEST CORRELATION:'] + split[n:])
 
         return f"**User Correlations for {escape_markdown(user[1])}**\n```\n{out_text}\n```", None
 
+    @stats_command('delta')
+    @cached_stats
     def get_message_deltas(self, lquery: str = None, start: str = None, end: str = None, n: int = 10, thresh: int = 500,
                            autouser=None, **kwargs) -> Tuple[Union[str, None], Union[None, BytesIO]]:
         """
@@ -892,23 +1171,9 @@ class StatsRunner(object):
         :param thresh: Only consider users with at least this many message group pairs with you
         """
         user: Tuple[int, str] = kwargs['user']
-        query_conditions = []
         sql_dict = {}
-
-        if lquery:
-            query_conditions.append(f"text_index_col @@ to_tsquery( {random_quote(lquery)} )")
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
-
-        query_where = ""
-        if query_conditions:
-            query_where = f"AND {' AND '.join(query_conditions)}"
+        query_where = self._build_where(sql_dict, lquery=lquery, start=start, end=end, prefix='AND')
+        source, _ = self._count_source(lquery, sql_dict, view=None)
 
         if n <= 0:
             raise HelpException(f'n must be greater than 0')
@@ -916,52 +1181,49 @@ class StatsRunner(object):
         if thresh < 0:
             raise HelpException(f'n cannot be negative')
 
-        def fetch_mean_delta(me: int, other: int, where: str, sql_dict: dict) -> Tuple[timedelta, int]:
-            query = f"""
-                    select percentile_cont(0.5) within group (order by t_delta), count(t_delta)
-                    from(
-                        select start - lag("end", 1) over (order by start) as t_delta
-                        from (
-                                 select min(date) as start, max(date) as "end"
-                                 from (select date, from_user,
-                                              (dense_rank() over (order by date) -
-                                               dense_rank() over (partition by from_user order by date)
-                                                  ) as grp
-                                       from messages_utc
-                                       where from_user in (:me, :other) {where}
-                                       order by date
-                                      ) t
-                                 group by from_user, grp
-                                 order by start
-                        ) t1
-                    ) t2;
-                    """
-
-            sql_dict['me'] = me
-            sql_dict['other'] = other
-
-            with self.engine.connect() as con:
-                result = con.execute(text(query), sql_dict)
-            output: Tuple[timedelta, int] = result.fetchall()[0]
+        # Every pair needs its own run grouping, so partition by the other user and do them all in one pass
+        query = f"""
+                select other, percentile_cont(0.5) within group (order by t_delta), count(t_delta)
+                from(
+                    select other, start - lag("end", 1) over (partition by other order by start) as t_delta
+                    from (
+                             select other, min(date) as start, max(date) as "end"
+                             from (select other, date, from_user,
+                                          (dense_rank() over (partition by other order by date) -
+                                           dense_rank() over (partition by other, from_user order by date)
+                                              ) as grp
+                                   from (select date, from_user
+                                         from {source}
+                                         where from_user = any(CAST(:users AS bigint[])) {query_where}
+                                        ) msgs
+                                   join unnest(CAST(:others AS bigint[])) as other on from_user in (:me, other)
+                                  ) t
+                             group by other, from_user, grp
+                    ) t1
+                ) t2
+                group by other;
+                """
 
-            return output
+        sql_dict['me'] = user[0]
+        sql_dict['others'] = self.usernames.index.drop(user[0], errors='ignore').tolist()
+        sql_dict['users'] = [user[0]] + sql_dict['others']
 
-        results = {other: fetch_mean_delta(user[0], other, query_where, sql_dict) for other in self.users
-                   if user[0] != other}
+        with self.connect() as con:
+            results = {other: (t_delta, count) for other, t_delta, count in con.execute(text(query), sql_dict)}
 
-        user_deltas = {self.users[other][0]: pd.to_timedelta(result[0]) for other, result in results.items()
-                       if result[1] > thresh}
+        user_deltas = {other: pd.to_timedelta(result[0]) for other, result in results.items() if result[1] > thresh}
 
-        me = pd.Series(user_deltas).sort_values()
-        me = me.apply(lambda x: x.round('1s'))
+        me = pd.Series(user_deltas, dtype='timedelta64[ns]').rename(self.usernames).sort_values()
 
         if len(me) < 1:
             return "\n```\nSorry, not enough data, try a bigger date range or decrease -thresh.\n```", None
 
-        out_text = me.iloc[:n].to_string(header=False, index=True)
+        out_text = format_series([(name, str(delta.round('1s'))) for name, delta in me.iloc[:n].items()])
 
         return f"**Median message delays for {escape_markdown(user[1])} and:**\n```\n{out_text}\n```", None
 
+    @stats_command('types')
+    @cached_stats
     def get_type_stats(self, start: str = None, end: str = None, autouser=None, **kwargs) -> Tuple[str, None]:
         """
         Print table of message statistics by type.
@@ -969,76 +1231,40 @@ class StatsRunner(object):
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         """
         user: Tuple[int, str] = kwargs['user']
-        query_conditions = []
-        sql_dict = {}
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
+        sql_dict = {'start_dt': pd.to_datetime(start) if start else None,
+                    'end_dt': pd.to_datetime(end) if end else None,
+                    'user': user[0] if user else None,
+                    'excluded_types': excluded_types}
 
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
+        source, _ = self._count_source(None, sql_dict, view='messages_type_daily', freq='d')
 
-        query_where = ""
-        if query_conditions:
-            query_where = f" AND {' AND '.join(query_conditions)}"
+        with self.connect() as con:
+            result = con.execute(type_stats_queries[source], sql_dict).fetchall()
 
-        query = f"""
-                    SELECT type, count(*) as count
-                    FROM messages_utc
-                    WHERE type NOT IN ('new_chat_members', 'left_chat_member', 'new_chat_photo',
-                                       'new_chat_title', 'migrate_from_group', 'pinned_message')
-                          {query_where}
-                    GROUP BY type
-                    ORDER BY count DESC;
-                 """
-
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict)
+        if not user:
+            result = [row[:3] for row in result]  # Drop user columns
 
-        if len(df) == 0:
+        if len(result) == 0:
             return 'No messages in range', None
 
-        df['Group Percent'] = df['count'] / df['count'].sum() * 100
-        df.columns = ['type', 'Group Count', 'Group Percent']
-
+        # At most a dozen rows, so format by hand rather than building a DataFrame
+        columns = ['type', 'Group Count', 'Group Percent']
         if user:
-            sql_dict['user'] = user[0]
-            query_conditions.append("from_user = :user")
+            columns += ['User Count', 'User Percent']
 
-            query = f"""
-                        SELECT type, count(*) as user_count
-                        FROM messages_utc
-                        WHERE type NOT IN ('new_chat_members', 'left_chat_member', 'new_chat_photo',
-                                           'new_chat_title', 'migrate_from_group', 'pinned_message')
-                              AND {' AND '.join(query_conditions)}
-                        GROUP BY type
-                        ORDER BY user_count DESC;
-                     """
-            with self.engine.connect() as con:
-                df_u = pd.read_sql_query(text(query), con, params=sql_dict)
-            df_u['User Percent'] = df_u['user_count'] / df_u['user_count'].sum() * 100
-            df_u.columns = ['type', 'User Count', 'User Percent']
-
-            df = df.merge(df_u, on="type", how="outer")
-
-        a = list(zip(df.columns.values, ["Total"] + df.iloc[:, 1:].sum().to_list()))
-        df = pd.concat((df, pd.DataFrame({key: [value] for key, value in a})), ignore_index=True)
-
-        df['Group Count'] = df['Group Count'].astype('Int64')
-        try:
-            df['User Count'] = df['User Count'].astype('Int64')
-        except KeyError:
-            pass
-
-        out_text = df.to_string(index=False, header=True, float_format=lambda x: f"{x:.1f}")
+        rows = [[mtype, *map(format_cell, values)] for mtype, *values in result]
+        totals = [sum(row[i] for row in result) for i in range(1, len(columns), 2)]  # Count columns only
+        rows.append(['Total', *(cell for total in totals
+                                for cell in (str(total), format_cell(100.0 if total else None)))])
+        out_text = format_table(columns, rows)
 
         if user:
             return f"**Messages by type, {escape_markdown(user[1])} vs group:**\n```\n{out_text}\n```", None
         else:
             return f"**Messages by type:**\n```\n{out_text}\n```", None
 
+    @stats_command('words')
+    @cached_stats
     def get_word_stats(self, n: int = 4, limit: int = 20, start: str = None, end: str = None,
                        user: Tuple[int, str] = None, **kwargs) -> Tuple[str, None]:
         """
@@ -1074,21 +1300,21 @@ class StatsRunner(object):
             stmt = stmt.limit(limit) \
                 .compile(dialect=postgresql.dialect())
 
-        with self.engine.connect() as con:
+        with self.connect() as con:
             df = pd.read_sql_query(stmt, con)
 
         if len(df) == 0:
             return 'No messages in range', None
 
-        df.columns = ['Lexeme', 'Messages', 'Uses']
-
-        out_text = df.to_string(index=False, header=True, float_format=lambda x: f"{x:.1f}")
+        out_text = format_table(['Lexeme', 'Messages', 'Uses'],
+                                [list(map(str, row)) for row in df.itertuples(index=False)])
 
         if user:
             return f"**Most frequently used lexemes, {escape_markdown(user[1].lstrip('@'))}\n```\n{out_text}\n```", None
         else:
             return f"**Most frequently used lexemes, all users:**\n```\n{out_text}\n```", None
 
+    @stats_command('random')
     def get_random_message(self, lquery: str = None, start: str = None, end: str = None,
                            user: Tuple[int, str] = None, **kwargs) -> Tuple[str, None]:
         """
@@ -1097,49 +1323,30 @@ class StatsRunner(object):
         :param start: Start timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         """
-        query_conditions = []
-        sql_dict = {}
-
-        if lquery:
-            query_conditions.append(f"text_index_col @@ to_tsquery( {random_quote(lquery)} )")
-
-        if user:
-            sql_dict['user'] = user[0]
-            query_conditions.append("from_user = :user")
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
-
-        query_where = ""
-        if query_conditions:
-            query_where = f"AND {' AND '.join(query_conditions)}"
-
-        query = f"""
-                    SELECT date, from_user, text
-                    FROM messages_utc
-                    WHERE type = 'text'
-                    {query_where}
-                    ORDER BY RANDOM()
-                    LIMIT 1;
-                """
-
-        with self.engine.connect() as con:
-            result = con.execute(text(query), sql_dict)
-        try:
-            date, from_user, out_text = result.fetchall()[0]
-        except IndexError:
+        sql_dict = {'lquery': lquery or None,
+                    'user': user[0] if user else None,
+                    'start_dt': pd.to_datetime(start) if start else None,
+                    'end_dt': pd.to_datetime(end) if end else None}
+
+        row = None
+        with self.connect() as con:
+            low, high = self.message_id_bounds
+            if not any(sql_dict.values()) and low is not None:
+                # Unfiltered: index lookup from a random message id, falls through if it lands past the last text
+                row = con.execute(random_message_id_query, {'message_id': random.randint(low, high)}).fetchone()
+            if row is None:
+                row = con.execute(random_message_query, sql_dict).fetchone()
+
+        if row is None:
             return "No matching messages", None
+        date, from_user, out_text = row
 
-        return f"*On {escape_markdown(date.strftime('%Y-%m-%d'))}, " \
-               f"{escape_markdown(self.users[from_user][0]).lstrip('@')}" \
-               f" gave these words of wisdom:*\n" \
-               f"{escape_markdown(out_text)}\n", \
-            None
+        return random_message_template.format_map({'date': date.strftime(r'%Y\-%m\-%d'),
+                                                   'user': self.escaped_usernames[from_user],
+                                                   'text': escape_markdown(out_text)}), None
+
+    # Subcommand names mapped to method names, in registration order
+    allowed_methods = {spec.name: spec.method for spec in command_specs}
 
 
 def get_parser(runner: StatsRunner) -> InternalParser:
@@ -1149,40 +1356,22 @@ def get_parser(runner: StatsRunner) -> InternalParser:
 
     parser.add_argument('-v', '--version', action='version', version=__version__)
 
-    for name, func in runner.allowed_methods.items():
-        try:
-            doc = inspect.getdoc(getattr(runner, func)).splitlines()
-        except AttributeError:
-            doc = None
-        subparser = subparsers.add_parser(name, help=doc[0])
-        subparser.set_defaults(func=getattr(runner, func))
-        f_args = inspect.signature(getattr(runner, func)).parameters
-
-        for _, arg in f_args.items():
-            arg: inspect.Parameter
-            if arg.name == 'self':
-                continue
-            if arg.name == 'user':
+    for spec in command_specs:
+        subparser = subparsers.add_parser(spec.name, help=spec.help)
+        subparser.set_defaults(func=getattr(runner, spec.method))
+
+        for arg in spec.args:
+            if arg.kind == 'user':
                 group = subparser.add_mutually_exclusive_group()
                 group.add_argument('-me', action='store_true', help='calculate stats for yourself')
                 group.add_argument('-user', type=int, help=argparse.SUPPRESS)
-            elif arg.name == 'autouser':
+            elif arg.kind == 'autouser':
                 subparser.set_defaults(me=True)
                 subparser.add_argument('-user', type=int, help=argparse.SUPPRESS)
-            elif arg.name == 'kwargs':
-                pass
+            elif arg.kind == 'flag':
+                subparser.add_argument(f"-{arg.name}".replace('_', '-'), action='store_true', help=arg.help)
             else:
-                arg_doc = None
-                if doc:
-                    for line in doc:
-                        match = re.match(rf"^:param {arg.name}: (.*)", line)
-                        if match:
-                            arg_doc = match.group(1)
-
-                if arg.annotation == bool:
-                    subparser.add_argument(f"-{arg.name}".replace('_', '-'), action='store_true', help=arg_doc)
-                else:
-                    subparser.add_argument(f"-{arg.name}".replace('_', '-'), type=arg.annotation, help=arg_doc,
-                                           default=arg.default)
+                subparser.add_argument(f"-{arg.name}".replace('_', '-'), type=arg.type, help=arg.help,
+                                       default=arg.default)
 
     return parser
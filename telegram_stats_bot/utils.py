@@ -21,6 +21,10 @@
 import string
 import secrets
 import re
+import time
+from collections import OrderedDict
+from threading import Lock, Event
+from typing import Hashable, Any, Callable, Dict
 
 from sqlalchemy import Column, Integer, Text
 from sqlalchemy.ext.compiler import compiles
@@ -28,16 +32,25 @@ from sqlalchemy.sql.functions import FunctionElement
 from sqlalchemy.sql.base import ColumnCollection
 
 
-md_match = re.compile(r"(\[[^][]*]\(http[^()]*\))|([_*[\]()~>#+-=|{}.!\\])")
+md_url_match = re.compile(r"\[[^][]*]\(http[^()]*\)")
+# Reserved markdown characters, plus everything in the +-= range (escaping those is harmless)
+md_escape_chars = '_*[]()~>#|{}.!\\' + ''.join(map(chr, range(ord('+'), ord('=') + 1)))
+md_escape_table = str.maketrans({c: '\\' + c for c in md_escape_chars})
 
 
 def escape_markdown(string: str) -> str:
-    def url_match(match: re.Match):
-        if match.group(1):
-            return f'{match.group(1)}'
-        return f'\\{match.group(2)}'
+    if '[' not in string:  # No links possible, escape everything in one pass
+        return string.translate(md_escape_table)
 
-    return re.sub(md_match, url_match, string)
+    parts = []
+    pos = 0
+    for match in md_url_match.finditer(string):
+        parts.append(string[pos:match.start()].translate(md_escape_table))
+        parts.append(match.group())
+        pos = match.end()
+    parts.append(string[pos:].translate(md_escape_table))
+
+    return ''.join(parts)
 
 
 # Modified from https://stackoverflow.com/a/49726653/3946475
@@ -66,3 +79,75 @@ def pg_ts_stat(element, compiler, **kw):
 def random_quote(statement: str) -> str:
     quote_str = ''.join(secrets.choice(string.ascii_uppercase) for _ in range(8))  # Randomize dollar quotes
     return f"${quote_str}${statement}${quote_str}$"
+
+
+class TTLCache(object):
+    """
+    Small LRU mapping whose entries expire ttl seconds after being set.
+    Missing and expired keys raise KeyError.
+    """
+    def __init__(self, ttl: float = 300, maxsize: int = 128):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+    def __getitem__(self, key: Hashable) -> Any:
+        with self._lock:
+            timestamp, value = self._data[key]
+            if time.monotonic() - timestamp > self.ttl:
+                del self._data[key]
+                raise KeyError(key)
+            self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = time.monotonic(), value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls with the same key: the first caller runs the function,
+    later callers wait for it and share its result (or exception).
+    """
+    class _Call(object):
+        def __init__(self):
+            self.done = Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls: Dict[Hashable, SingleFlight._Call] = {}
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
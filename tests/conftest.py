@@ -1,4 +1,6 @@
 import datetime
+import functools
+import random
 import secrets
 from datetime import timedelta, timezone
 import json
@@ -12,11 +14,16 @@ from telegram_stats_bot.db import db_sql
 from telegram_stats_bot.log_storage import messages, user_names
 
 
+@functools.cache
+def load_words(source: str) -> list[str]:
+    with open(source) as word_database:
+        return list(json.load(word_database).keys())
+
+
 class RandomWords(Local):
     def __init__(self):
         super().__init__()
-        with open(self.source) as word_database:
-            self.words = list(json.load(word_database).keys())  # Cache loaded file
+        self.words = load_words(self.source)  # Parse the file once, shared by every instance
 
     def get_random_word(self):
         """
@@ -24,6 +31,12 @@ class RandomWords(Local):
         """
         return secrets.choice(self.words)
 
+    def get_random_words(self, k: int) -> list[str]:
+        """
+        Draw k words in one call instead of one choice per word.
+        """
+        return random.choices(self.words, k=k)
+
 
 def generate_user_names(n_users=10) -> list[dict]:
     random_words = RandomWords()
@@ -39,6 +52,7 @@ def generate_user_names(n_users=10) -> list[dict]:
 def generate_message_data(n_rows=5000, n_users=10, n_titles=3) -> list[dict]:
     random_words = RandomWords()
     start_date = datetime.datetime(2020, 1, 1, 0, 0, 0, tzinfo=timezone.utc)
+    words = random_words.get_random_words(n_rows * 10)
 
     chat = [{'message_id': n,
              'date': start_date + timedelta(hours=n),
@@ -47,7 +61,7 @@ def generate_message_data(n_rows=5000, n_users=10, n_titles=3) -> list[dict]:
              'forward_from': None,
              'forward_from_chat': None,
              'caption': None,
-             'text': ' '.join([random_words.get_random_word() for _ in range(10)]),
+             'text': ' '.join(words[n * 10:(n + 1) * 10]),
              'sticker_set_name': None,
              'new_chat_title': None,
              'reply_to_message': None,
@@ -75,7 +89,12 @@ def load_database(**kwargs):
     with engine.connect() as con:
         con.execute(text(db_sql))
         con.execute(user_names.insert(), user_table)
-        con.execute(messages.insert(), message_table)
+        # COPY the messages in one stream rather than an executemany of inserts
+        columns = list(message_table[0])
+        with con.connection.driver_connection.cursor() as cursor, \
+                cursor.copy(f"COPY {messages.name} ({', '.join(columns)}) FROM STDIN") as copy:
+            for row in message_table:
+                copy.write_row([row[column] for column in columns])
         con.commit()
 
 
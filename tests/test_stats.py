@@ -1,7 +1,13 @@
+import time
 from io import BytesIO
+from threading import Event, Thread
+
+from sqlalchemy import text
 
 from tests.conftest import n_users, n_rows, user_table
+from telegram_stats_bot.log_storage import messages
 from telegram_stats_bot.stats import StatsRunner, HelpException
+from telegram_stats_bot.utils import SingleFlight
 
 import pytest
 
@@ -11,10 +17,31 @@ def sr(db_connection):
     return StatsRunner(db_connection)
 
 
+def insert_message(db_connection, message_id: int):
+    with db_connection.begin() as con:
+        con.execute(messages.insert(), {'message_id': message_id, 'date': '2021-01-01', 'from_user': 0,
+                                        'text': 'new', 'type': 'text'})
+        con.execute(text("SELECT pg_stat_force_next_flush();"))  # Make the write visible to refresh_views now
+
+
 def test_get_message_user_ids(sr):
     assert set(sr.get_message_user_ids()) == set(range(len(user_table)))
 
 
+def test_refresh_views(sr, db_connection):
+    with db_connection.connect() as con:
+        assert con.execute(text("select sum(cnt) from messages_hourly")).fetchone()[0] == n_rows
+        assert con.execute(text("select sum(cnt) from messages_type_daily")).fetchone()[0] == n_rows
+
+
+def test_connect_shared(sr):
+    with sr.connect() as con:
+        with sr.connect() as inner:
+            assert inner is con
+    with sr.connect() as other:
+        assert other is not con
+
+
 def test_get_db_users(sr):
     for k, v in sr.get_db_users().items():
         username, display_name = v
@@ -22,6 +49,14 @@ def test_get_db_users(sr):
         assert display_name == user_table[k]['display_name']
 
 
+def test_update_user_ids(sr):
+    sr.update_user_ids({0: ('@renamed', None), 1: ('@new', 'New Name')})
+    users = sr.get_db_users()
+    assert users[0] == ('@renamed', user_table[0]['display_name'])
+    assert users[1] == ('@new', 'New Name')
+    assert users[2] == (user_table[2]['username'], user_table[2]['display_name'])
+
+
 @pytest.mark.usefixtures('sr')
 class TestChatCounts:
     def test_basic(self, sr):
@@ -51,6 +86,17 @@ class TestChatCounts:
     def test_end_valid(self, sr):
         assert sr.get_chat_counts(end='2025')[0].count('\n') == 2 + n_users
 
+    def test_missing_username(self, sr):
+        users = {user['user_id']: (user['username'], user['display_name']) for user in user_table}
+        users[0] = (None, 'Nameless')
+        del users[1]  # Not in user_names at all
+        sr.users = users
+        out_text = sr.get_chat_counts()[0]
+        names = [line.split()[0] for line in out_text.splitlines()[2:-1]]
+        assert 'Nameless' in names
+        assert '1' in names
+        assert 'NaN' not in names and 'None' not in names
+
 
 class TestChatECDF:
     def test_basic(self, sr):
@@ -281,6 +327,11 @@ class TestDeltas:
         assert 'Sorry' in sr.get_message_deltas(
             thresh=3000, user=(0, user_table[0]['username']))[0]
 
+    def test_single_user(self, sr):
+        sr.users = {0: (user_table[0]['username'], user_table[0]['display_name'])}
+        assert 'Sorry' in sr.get_message_deltas(
+            user=(0, user_table[0]['username']))[0]
+
 
 class TestTypeStats:
     def test_basic(self, sr):
@@ -335,6 +386,9 @@ class TestWordStats:
 
 
 class TestRandom:
+    def test_unfiltered(self, sr):
+        assert sr.get_random_message()[0] != 'No matching messages'
+
     def test_basic(self, sr):
         assert sr.get_random_message(
             user=(0, user_table[0]['username']))[0] != 'No matching messages'
@@ -359,3 +413,113 @@ class TestRandom:
         assert sr.get_random_message(
             end='2025', user=(0, user_table[0]['username']))[0] != 'No matching messages'
 
+
+class TestParser:
+    def test_default(self, sr):
+        assert sr.parser.parse_args([]).func == sr.get_chat_counts
+
+    def test_subcommand(self, sr):
+        ns = sr.parser.parse_args(['counts', '-n', '3', '-mtype', 'text'])
+        assert ns.func == sr.get_chat_counts
+        assert ns.n == 3
+        assert ns.mtype == 'text'
+
+    def test_reuse(self, sr):
+        sr.parser.parse_args(['corr', '-agg'])
+        assert sr.parser.parse_args(['corr']).agg is False
+
+    def test_help(self, sr):
+        with pytest.raises(HelpException) as e:
+            sr.parser.parse_args(['counts', '-h'])
+        assert 'Number of users to show' in e.value.msg
+
+
+class TestStatsCache:
+    def test_hit(self, sr):
+        assert sr.get_type_stats(user=None) is sr.get_type_stats(user=None)
+
+    def test_args(self, sr):
+        assert sr.get_type_stats(user=None) != sr.get_type_stats(user=(0, user_table[0]['username']))
+
+    def test_refresh(self, sr, db_connection):
+        first = sr.get_type_stats(user=None)
+        insert_message(db_connection, n_rows)
+        sr.refresh_views()
+        assert sr.get_type_stats(user=None) is not first
+
+    def test_refresh_id_in_range(self, sr, db_connection):
+        first = sr.get_type_stats(user=None)
+        insert_message(db_connection, n_rows // 2)  # Doesn't move the message id bounds
+        sr.refresh_views()
+        assert sr.get_type_stats(user=None) is not first
+        with db_connection.connect() as con:
+            assert con.execute(text("select sum(cnt) from messages_hourly")).fetchone()[0] == n_rows + 1
+
+    def test_refresh_unchanged(self, sr):
+        first = sr.get_type_stats(user=None)
+        sr.refresh_views()  # Nothing logged, so views and cache are kept
+        assert sr.get_type_stats(user=None) is first
+
+    def test_expired(self, sr):
+        first = sr.get_type_stats(user=None)
+        sr.stats_cache.ttl = -1
+        assert sr.get_type_stats(user=None) is not first
+
+    def test_image(self, sr):
+        first = sr.get_counts_by_hour()[1]
+        second = sr.get_counts_by_hour()[1]
+        assert first is not second
+        assert first.read() == second.read()
+
+
+class TestSingleFlight:
+    @staticmethod
+    def run_pair(flight: SingleFlight, result=None, error=None) -> tuple[list, list]:
+        """Run a leader and a concurrent follower with the same key, returning the calls made and their outcomes."""
+        started, release = Event(), Event()
+        calls, outcomes = [], []
+
+        def func():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            if error:
+                raise error
+            return result
+
+        def caller():
+            try:
+                outcomes.append(flight.do('key', func))
+            except Exception as e:
+                outcomes.append(e)
+
+        leader = Thread(target=caller)
+        leader.start()
+        started.wait(5)
+        follower = Thread(target=caller)
+        follower.start()
+        time.sleep(0.1)  # Let the follower block on the leader's call
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        return calls, outcomes
+
+    def test_shared_result(self):
+        flight = SingleFlight()
+        calls, outcomes = self.run_pair(flight, result='result')
+        assert len(calls) == 1
+        assert outcomes == ['result', 'result']
+        assert 'key' not in flight._calls
+
+    def test_shared_exception(self):
+        flight = SingleFlight()
+        error = ValueError('failed')
+        calls, outcomes = self.run_pair(flight, error=error)
+        assert len(calls) == 1
+        assert outcomes == [error, error]
+        assert 'key' not in flight._calls
+
+    def test_key_released(self):
+        flight = SingleFlight()
+        assert flight.do('key', lambda: 1) == 1
+        assert flight.do('key', lambda: 2) == 2